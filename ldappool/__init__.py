@@ -35,18 +35,53 @@
 # ***** END LICENSE BLOCK *****
 """ LDAP Connection Pool.
 """
+from collections import defaultdict
+from collections import namedtuple
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+import copy
+import hashlib
+import heapq
 import logging
-from threading import RLock
+import random
+import sys
+from threading import BoundedSemaphore
+from threading import Lock
 import time
 
 import ldap
+import ldap.dn
 from ldap.ldapobject import ReconnectLDAPObject
-from prettytable import PrettyTable
+from ldap.ldapobject import SimpleLDAPObject
 import re
 
 log = logging.getLogger(__name__)
 
+# URIs can be delimited by either commas or whitespace
+_URI_SEPARATOR = re.compile(r'[\s,]+')
+
+# maximum number of failed binds remembered by a ConnectionManager
+_AUTH_FAILURES_MAX = 256
+
+# time waited for a connector to be released, per retry, when the pool is
+# full
+_POOL_FULL_WAIT = .1
+
+# maximum number of threads used to prefill a pool
+_PREFILL_WORKERS_MAX = 8
+
+# errors raised as-is, rather than wrapped in a BackendError, when no
+# connector could be created
+_CONNECT_ERRORS = (ldap.NO_SUCH_OBJECT, ldap.SERVER_DOWN, ldap.TIMEOUT)
+
+# outcome of the attempts to bind a connector to one of the servers
+_BindResult = namedtuple('_BindResult', ['ok', 'conn', 'error'])
+
+# utf8_encode fast path, looked up by exact type
+_ENCODERS = {str: lambda value: value.encode('utf-8'),
+             bytes: lambda value: value}
+
 
 def utf8_encode(value):
     """Encode a basestring to UTF-8.
@@ -58,6 +93,11 @@ def utf8_encode(value):
     :returns: UTF-8 encoded version of value
     :raises TypeError: If value is not basestring
     """
+    encoder = _ENCODERS.get(type(value))
+    if encoder is not None:
+        return encoder(value)
+
+    # subclasses of str and bytes
     if isinstance(value, str):
         return value.encode('utf-8')
     elif isinstance(value, bytes):
@@ -67,6 +107,116 @@ def utf8_encode(value):
                         % type(value).__name__)
 
 
+def _normalize_dn(dn):
+    """Parses a DN into a tuple of RDNs, to compare it with others.
+
+    Attribute types are lower-cased and the values of multi-valued RDNs
+    sorted, values keep their case.
+
+    :param dn: the DN to normalize.
+    :returns: a tuple of RDNs, each a tuple of (type, value) pairs, or None
+              if the DN can't be parsed.
+    """
+    try:
+        rdns = ldap.dn.str2dn(dn)
+    except ldap.DECODING_ERROR:
+        return None
+    return tuple(tuple(sorted((attr.lower(), value)
+                              for attr, value, _ in rdn))
+                 for rdn in rdns)
+
+
+def _fold_dn(dn):
+    """Lower-cases the values of a normalized DN.
+
+    Most directories match DN values case-insensitively, so let's use it
+    wherever being too broad is harmless.
+    """
+    return tuple(tuple((attr, value.lower()) for attr, value in rdn)
+                 for rdn in dn)
+
+
+def _dn_within(dn, base):
+    """Tells if a normalized DN is base or one of its descendants."""
+    return len(base) <= len(dn) and dn[len(dn) - len(base):] == base
+
+
+class _SearchCache(object):
+    """Time-bounded LRU cache of search results.
+
+    It is shared by all the connectors of a ConnectionManager. Results are
+    keyed by the bound DN, so that a user never gets entries fetched with
+    someone else's access rights, and copied in and out of the cache so
+    that callers can't alter cached entries.
+    """
+
+    def __init__(self, ttl, size, base_dns=None):
+        self.ttl = ttl
+        self.size = size
+        if base_dns is not None:
+            normalized = []
+            for dn in base_dns:
+                parsed = _normalize_dn(dn)
+                if parsed is None:
+                    raise ValueError('Invalid cache base DN %r' % dn)
+                normalized.append(_fold_dn(parsed))
+            base_dns = tuple(normalized)
+        self.base_dns = base_dns
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def key(self, who, base, scope, filterstr, attrlist, attrsonly):
+        """Returns the cache key of a search, None if it can't be cached."""
+        base = _normalize_dn(base)
+        if base is None:
+            return None
+        if self.base_dns is not None:
+            folded = _fold_dn(base)
+            if not any(_dn_within(folded, base_dn)
+                       for base_dn in self.base_dns):
+                return None
+        if attrlist is not None:
+            attrlist = tuple(sorted(attrlist))
+        return who, base, scope, filterstr, attrlist, attrsonly
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expiry, result = entry
+            if time.monotonic() >= expiry:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+        return copy.deepcopy(result)
+
+    def set(self, key, result):
+        entry = time.monotonic() + self.ttl, copy.deepcopy(result)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, dn):
+        """Drops the cached searches that may contain the entry dn."""
+        dn = _normalize_dn(dn)
+        with self._lock:
+            if dn is None:
+                # we can't tell which searches it belongs to
+                self._entries.clear()
+                return
+            dn = _fold_dn(dn)
+            for key in list(self._entries):
+                _, base, scope = key[:3]
+                base = _fold_dn(base)
+                if dn == base:
+                    del self._entries[key]
+                elif scope != ldap.SCOPE_BASE and _dn_within(dn, base):
+                    del self._entries[key]
+
+
 class MaxConnectionReachedError(Exception):
     pass
 
@@ -85,23 +235,58 @@ class StateConnector(ReconnectLDAPObject):
         self.connected = False
         self.who = ''
         self.cred = ''
+        self.max_lifetime = None
+        self._search_cache = None
         self._connection_time = None
+        self._expiry_time = None
+        self._tls_started = False
 
     def get_lifetime(self):
         """Returns the lifetime of the connection on the server in seconds."""
         if self._connection_time is None:
             return 0
-        return time.time() - self._connection_time
+        return time.monotonic() - self._connection_time
 
     def simple_bind_s(self, who='', cred='', serverctrls=None,
                       clientctrls=None):
         res = ReconnectLDAPObject.simple_bind_s(self, who, cred, serverctrls,
                                                 clientctrls)
         self.connected = True
+        # the bind DN keys the pool buckets, and is shared by all the
+        # connectors of a user. Credentials are not interned, so that
+        # they are not kept alive for the lifetime of the process.
+        if type(who) is str:
+            who = sys.intern(who)
         self.who = who
         self.cred = cred
         if self._connection_time is None:
-            self._connection_time = time.time()
+            self._connection_time = time.monotonic()
+            if self.max_lifetime is not None:
+                self._expiry_time = self._connection_time + self.max_lifetime
+        return res
+
+    def reconnect(self, *args, **kwargs):
+        previous = getattr(self, '_l', None)
+        # python-ldap unbinds the connection it replaces, which resets
+        # this state, then starts TLS and binds the new one as before
+        state = self.connected, self.who, self.cred, self._tls_started
+        try:
+            res = ReconnectLDAPObject.reconnect(self, *args, **kwargs)
+        except ldap.LDAPError:
+            # the server could not be reached again, this connector
+            # should be dropped instead of going back to the pool
+            self.connected = False
+            raise
+
+        if getattr(self, '_l', None) is not previous:
+            # a brand new connection was opened, bound as the old one,
+            # and its lifetime starts now
+            self.connected, self.who, self.cred, self._tls_started = state
+            if self._connection_time is not None:
+                now = time.monotonic()
+                self._connection_time = now
+                if self.max_lifetime is not None:
+                    self._expiry_time = now + self.max_lifetime
         return res
 
     def unbind_ext_s(self, serverctrls=None, clientctrls=None):
@@ -110,16 +295,105 @@ class StateConnector(ReconnectLDAPObject):
                                                     clientctrls)
         finally:
             self.connected = False
+            self._tls_started = False
             self.who = None
             self.cred = None
 
-    def add_s(self, *args, **kwargs):
-        return self._apply_method_s(ReconnectLDAPObject.add_s, *args,
-                                    **kwargs)
+    def _bound_dn(self):
+        """Returns the DN the connection is bound as, None if unknown.
+
+        This is the DN python-ldap binds with again when it reconnects,
+        so unlike who it can't be reset while the connection stays bound.
+        """
+        if not self.connected:
+            return None
+
+        last_bind = getattr(self, '_last_bind', None)
+        if last_bind is None:
+            return None
+
+        func, args, kwargs = last_bind
+        if func is not SimpleLDAPObject.simple_bind_s:
+            # not a simple bind
+            return None
+        if args:
+            return args[0]
+        return kwargs.get('who')
+
+    def search_s(self, base, scope, filterstr='(objectClass=*)',
+                 attrlist=None, attrsonly=0):
+        cache = self._search_cache
+        key = None
+        if cache is not None:
+            # results are only shared by connectors known to be bound as
+            # the same user
+            who = self._bound_dn()
+            if who is not None:
+                key = cache.key(who, base, scope, filterstr, attrlist,
+                                attrsonly)
+
+        if key is not None:
+            res = cache.get(key)
+            if res is not None:
+                return res
+
+        res = ReconnectLDAPObject.search_s(self, base, scope, filterstr,
+                                           attrlist, attrsonly)
+        if key is not None:
+            cache.set(key, res)
+        return res
+
+    def _uncache(self, dn):
+        if self._search_cache is not None:
+            self._search_cache.invalidate(dn)
+
+    # python-ldap's add_s, modify_s and delete_s go through their *_ext_s
+    # versions, so let's drop the cached searches there
+
+    def add_ext_s(self, dn, *args, **kwargs):
+        try:
+            return ReconnectLDAPObject.add_ext_s(self, dn, *args, **kwargs)
+        finally:
+            self._uncache(dn)
+
+    def modify_ext_s(self, dn, *args, **kwargs):
+        try:
+            return ReconnectLDAPObject.modify_ext_s(self, dn, *args, **kwargs)
+        finally:
+            self._uncache(dn)
+
+    def delete_ext_s(self, dn, *args, **kwargs):
+        try:
+            return ReconnectLDAPObject.delete_ext_s(self, dn, *args, **kwargs)
+        finally:
+            self._uncache(dn)
+
+    def passwd_s(self, user, *args, **kwargs):
+        try:
+            return ReconnectLDAPObject.passwd_s(self, user, *args, **kwargs)
+        finally:
+            # without a user, the password of the bound one is changed
+            if user is None:
+                user = self._bound_dn()
+            if user is not None:
+                self._uncache(user)
 
-    def modify_s(self, *args, **kwargs):
-        return self._apply_method_s(ReconnectLDAPObject.modify_s, *args,
-                                    **kwargs)
+    def rename_s(self, dn, newrdn, newsuperior=None, *args, **kwargs):
+        try:
+            return ReconnectLDAPObject.rename_s(self, dn, newrdn, newsuperior,
+                                                *args, **kwargs)
+        finally:
+            self._uncache(dn)
+            if newsuperior is None:
+                try:
+                    newsuperior = ldap.dn.dn2str(ldap.dn.str2dn(dn)[1:])
+                except ldap.DECODING_ERROR:
+                    # the whole cache was dropped already
+                    pass
+            if newsuperior:
+                self._uncache('%s,%s' % (newrdn, newsuperior))
+            else:
+                self._uncache(newrdn)
 
     def __str__(self):
         res = 'LDAP Connector'
@@ -146,79 +420,339 @@ class ConnectionManager(object):
     def __init__(self, uri, bind=None, passwd=None, size=10, retry_max=3,
                  retry_delay=.1, use_tls=False, timeout=-1,
                  connector_cls=StateConnector, use_pool=True,
-                 max_lifetime=600):
-        self._pool = []
-        self.size = size
+                 max_lifetime=600, max_backoff=None, retry_deadline=None,
+                 auth_failure_ttl=0, prefill=0, prefill_parallel=True,
+                 cache_ttl=0, cache_size=1024, cache_base_dns=None):
+        # every connector owned by the pool, in a fixed number of slots
+        self._pool = [None] * size
+        # bit i is set when slot i is free
+        self._free_slots = (1 << size) - 1
+        # position of each connector in _pool
+        self._slots = {}
+        # connectors currently handed out
+        self._active = set()
+        # idle connectors, bucketed by the (who, cred) they are bound with.
+        # Buckets are dicts used as ordered sets, in release order
+        self._inactive = defaultdict(dict)
+        # idle connectors in release order, used as an ordered set
+        self._inactive_order = {}
+        # (expiry, id(connector)) min-heap of connectors deadlines, and the
+        # (expiry, connector) each id was last scheduled with. The heap holds
+        # no reference, so discarded connectors are freed right away
+        self._expiry_heap = []
+        self._scheduled_expiry = {}
+        self._size = size
         self.retry_max = retry_max
         self.retry_delay = retry_delay
+        self.max_backoff = max_backoff
+        self.retry_deadline = retry_deadline
         self.uri = uri
         self.bind = bind
         self.passwd = passwd
-        self._pool_lock = RLock()
+        self._pool_lock = Lock()
+        # one permit per connector that can be handed out
+        self._capacity = BoundedSemaphore(size)
         self.use_tls = use_tls
         self.timeout = timeout
         self.connector_cls = connector_cls
         self.use_pool = use_pool
         self.max_lifetime = max_lifetime
+        self.auth_failure_ttl = auth_failure_ttl
+        # (bind, password digest) -> expiry of recently rejected credentials
+        self._auth_failures = {}
+        self._search_cache = None
+        if cache_ttl > 0:
+            self._search_cache = _SearchCache(cache_ttl, cache_size,
+                                              cache_base_dns)
+
+        # connectors that are not bound would be dropped on their first
+        # release, so there is nothing to prefill without a default bind
+        if self.use_pool and prefill > 0 and self.bind is not None:
+            self._prefill(min(prefill, self.size), prefill_parallel)
+
+    @property
+    def size(self):
+        # the slots and permits are allocated once, so let's keep it
+        # read-only
+        return self._size
+
+    @property
+    def uri(self):
+        return self._uri
+
+    @uri.setter
+    def uri(self, uri):
+        # the server list is only split again when the uri changes
+        self._uri = uri
+        self._servers = tuple(_URI_SEPARATOR.split(uri))
 
     def __len__(self):
-        return len(self._pool)
+        return len(self._slots)
 
-    def _match(self, bind, passwd):
-        with self._pool_lock:
-            inactives = []
+    def _pop_inactive(self, key):
+        """Pops the most recently released connector bound as key.
 
-            for conn in reversed(self._pool):
-                # already in usage
-                if conn.active:
-                    continue
+        Must be called with the pool lock held.
+        """
+        bucket = self._inactive.get(key)
+        if not bucket:
+            return None
+
+        conn, _ = bucket.popitem()
+        if not bucket:
+            del self._inactive[key]
+        del self._inactive_order[conn]
+        return conn
 
-                # let's check the lifetime
-                if conn.get_lifetime() > self.max_lifetime:
-                    # this connector has lived for too long,
-                    # we want to unbind it and remove it from the pool
-                    try:
-                        conn.unbind_s()
-                    except Exception:
-                        log.debug('Failure attempting to unbind after '
-                                  'timeout; should be harmless', exc_info=True)
-
-                    self._pool.remove(conn)
-                    continue
+    def _pop_oldest_inactive(self):
+        """Pops the least recently released connector, whatever its bind.
+
+        Must be called with the pool lock held.
+        """
+        conn = next(iter(self._inactive_order))
+        self._remove_inactive(conn)
+        return conn
+
+    def _remove_inactive(self, conn):
+        """Takes an idle connector out of its bucket and the release order.
+
+        Must be called with the pool lock held.
+        """
+        del self._inactive_order[conn]
+        key = (conn.who, conn.cred)
+        bucket = self._inactive[key]
+        del bucket[conn]
+        if not bucket:
+            del self._inactive[key]
+
+    def _sweep_expired(self, now, expired):
+        """Drops the inactive connectors that have lived for too long.
+
+        Only the connectors whose deadline has passed are looked at. They
+        are collected in expired, so that the caller can unbind them once
+        the pool lock is released. Must be called with the pool lock held.
+        """
+        heap = self._expiry_heap
+        while heap and heap[0][0] <= now:
+            expiry, key = heapq.heappop(heap)
+            scheduled = self._scheduled_expiry.get(key)
+            if scheduled is None or scheduled[0] != expiry:
+                # the connector is gone or got a new deadline
+                continue
+
+            del self._scheduled_expiry[key]
+            conn = scheduled[1]
+            if conn in self._inactive_order:
+                self._discard(conn)
+                expired.append(conn)
+            # connectors in use are dropped when released
+
+    def _unbind_expired(self, expired):
+        for conn in expired:
+            try:
+                conn.unbind_s()
+            except Exception:
+                log.debug('Failure attempting to unbind after '
+                          'timeout; should be harmless', exc_info=True)
+
+    def _push_inactive(self, conn):
+        """Makes a connector available for reuse.
+
+        Must be called with the pool lock held.
+        """
+        conn.active = False
+        self._inactive[(conn.who, conn.cred)][conn] = None
+        self._inactive_order[conn] = None
+
+        expiry = conn._expiry_time
+        if expiry is None:
+            return
+
+        scheduled = self._scheduled_expiry.get(id(conn))
+        if scheduled is None or scheduled[0] != expiry:
+            self._scheduled_expiry[id(conn)] = expiry, conn
+            heapq.heappush(self._expiry_heap, (expiry, id(conn)))
+            # the previous deadline, if any, is now stale
+            self._compact_expiry_heap()
+
+    def _discard(self, conn):
+        """Forgets about a connector.
+
+        Must be called with the pool lock held.
+        """
+        self._active.discard(conn)
+        if conn in self._inactive_order:
+            self._remove_inactive(conn)
+        if self._scheduled_expiry.pop(id(conn), None) is not None:
+            self._compact_expiry_heap()
+        if conn in self._slots:
+            self._remove_from_pool(conn)
+
+    def _compact_expiry_heap(self):
+        """Drops stale deadlines from the heap.
+
+        Stale entries are only dropped once they outnumber the pool size,
+        so that the cost of rebuilding the heap is spread over as many
+        calls.
+        The heap is rebuilt in place, as it may be being swept. Must be
+        called with the pool lock held.
+        """
+        heap = self._expiry_heap
+        if len(heap) <= 2 * self.size:
+            return
+
+        scheduled = self._scheduled_expiry
+        heap[:] = [(expiry, key) for expiry, key in heap
+                   if scheduled.get(key, (None,))[0] == expiry]
+        heapq.heapify(heap)
+
+    def _reserve_slot(self):
+        """Takes the lowest free slot, returns None if the pool is full.
+
+        Must be called with the pool lock held.
+        """
+        if not self._free_slots:
+            return None
+        slot = (self._free_slots & -self._free_slots).bit_length() - 1
+        self._free_slots &= ~(1 << slot)
+        return slot
+
+    def _add_to_pool(self, conn, slot):
+        """Puts a connector in a slot reserved with _reserve_slot.
+
+        Must be called with the pool lock held.
+        """
+        self._pool[slot] = conn
+        self._slots[conn] = slot
+
+    def _remove_from_pool(self, conn):
+        """Removes a connector from the pool in constant time.
+
+        Must be called with the pool lock held.
+        """
+        slot = self._slots.pop(conn)
+        self._pool[slot] = None
+        self._free_slots |= 1 << slot
+
+    def _match(self, bind, passwd):
+        # nothing to recycle. This is read without the lock: if another
+        # thread is releasing a connector right now, we will just create a
+        # new one and the pool size is checked again by the caller.
+        if not self._inactive:
+            return None
+
+        # the clock is only read when some connector has a deadline.
+        # The heap is looked at without the lock: a deadline pushed
+        # meanwhile will be honored by the next call.
+        now = time.monotonic() if self._expiry_heap else None
+        expired = []
+
+        try:
+            with self._pool_lock:
+                if now is not None:
+                    self._sweep_expired(now, expired)
 
                 # we found a connector for this bind
-                if conn.who == bind and conn.cred == passwd:
+                conn = self._pop_inactive((bind, passwd))
+                if conn is not None:
                     conn.active = True
+                    self._active.add(conn)
                     return conn
 
-                inactives.append(conn)
-
-            # no connector was available, let's rebind the latest inactive one
-            if len(inactives) > 0:
-                for conn in inactives:
-                    try:
-                        self._bind(conn, bind, passwd)
-                        return conn
-                    except Exception:
-                        log.debug('Removing connection from pool after '
-                                  'failure to rebind', exc_info=True)
-                        self._pool.remove(conn)
+            # no connector was available, let's rebind an inactive one.
+            # The candidate is taken out of the idle buckets under the lock
+            # but bound outside of it, so that other threads are not kept
+            # waiting on the network.
+            while True:
+                with self._pool_lock:
+                    if not self._inactive_order:
+                        # There are no connector that match
+                        return None
+                    # the connectors used most recently are kept bound
+                    # for the users that are likely to come back
+                    conn = self._pop_oldest_inactive()
+                    self._active.add(conn)
 
-                return None
+                try:
+                    self._bind(conn, bind, passwd)
+                except ldap.INVALID_CREDENTIALS:
+                    # rebinding other connectors would fail the same way
+                    # and could lock the LDAP account out
+                    log.debug('Removing connection from pool after '
+                              'failure to rebind', exc_info=True)
+                    with self._pool_lock:
+                        self._discard(conn)
+                    raise
+                except Exception:
+                    log.debug('Removing connection from pool after '
+                              'failure to rebind', exc_info=True)
+                    with self._pool_lock:
+                        self._discard(conn)
+                    continue
 
-        # There are no connector that match
-        return None
+                return conn
+        finally:
+            self._unbind_expired(expired)
 
     def _bind(self, conn, bind, passwd):
-        # let's bind
-        if self.use_tls:
+        # let's bind, TLS is only started once per connector, since
+        # ReconnectLDAPObject starts it again by itself on reconnection
+        if self.use_tls and not conn._tls_started:
             conn.start_tls_s()
+            conn._tls_started = True
 
         if bind is not None:
-            conn.simple_bind_s(bind, passwd)
+            try:
+                conn.simple_bind_s(bind, passwd)
+            except ldap.INVALID_CREDENTIALS:
+                self._remember_auth_failure(bind, passwd)
+                raise
 
         conn.active = True
 
+    def _auth_key(self, bind, passwd):
+        # only a digest of the password is kept around
+        if passwd is None:
+            passwd = b''
+        return bind, hashlib.sha256(utf8_encode(passwd)).digest()
+
+    def _remember_auth_failure(self, bind, passwd):
+        if not self.auth_failure_ttl:
+            return
+
+        key = self._auth_key(bind, passwd)
+        expiry = time.monotonic() + self.auth_failure_ttl
+        with self._pool_lock:
+            self._auth_failures.pop(key, None)
+            if len(self._auth_failures) >= _AUTH_FAILURES_MAX:
+                # forget the oldest failure
+                del self._auth_failures[next(iter(self._auth_failures))]
+            self._auth_failures[key] = expiry
+
+    def _check_auth_failure(self, bind, passwd):
+        """Fails early if these credentials were recently rejected.
+
+        :raises ldap.INVALID_CREDENTIALS: If a bind with the same
+            credentials failed less than auth_failure_ttl seconds ago
+        """
+        if not self._auth_failures or bind is None:
+            return
+
+        key = self._auth_key(bind, passwd)
+        with self._pool_lock:
+            expiry = self._auth_failures.get(key)
+            if expiry is None:
+                return
+            if time.monotonic() >= expiry:
+                del self._auth_failures[key]
+                return
+
+        log.debug('Credentials for %r were recently rejected; '
+                  'not attempting to bind', bind)
+        raise ldap.INVALID_CREDENTIALS({
+            'desc': 'Invalid credentials',
+            'info': 'a bind with these credentials recently failed'})
+
     def _create_connector(self, bind, passwd):
         """Creates a connector, binds it, and returns it.
 
@@ -229,66 +763,147 @@ class ConnectionManager(object):
         :returns: StateConnector
         :raises BackendError: If unable to connect to LDAP
         """
-        connected = False
+        deadline = None
+        if self.retry_deadline is not None:
+            deadline = time.monotonic() + self.retry_deadline
 
         # If multiple server URIs have been provided, loop through
         # each one in turn in case of connection failures (server down,
-        # timeout, etc.).  URIs can be delimited by either commas or
-        # whitespace.
-        for server in re.split(r'[\s,]+', self.uri):
-            tries = 0
-            exc = None
-            conn = None
-
-            # trying retry_max times in a row with a fresh connector
-            while tries < self.retry_max and not connected:
-                try:
-                    log.debug('Attempting to create a new connector '
-                              'to %s (attempt %d)', server, tries + 1)
-                    conn = self.connector_cls(server, retry_max=self.retry_max,
-                                              retry_delay=self.retry_delay)
-                    conn.timeout = self.timeout
-                    self._bind(conn, bind, passwd)
-                    connected = True
-                except ldap.INVALID_CREDENTIALS as error:
-                    # Treat this as a hard failure instead of retrying to
-                    # avoid locking out the LDAP account due to successive
-                    # failed bind attempts.  We also don't want to try
-                    # connecting to additional servers if multiple URIs were
-                    # provide, as failed bind attempts may be replicated
-                    # across multiple LDAP servers.
-                    exc = error
-                    log.error('Invalid credentials. Cancelling retry',
-                              exc_info=True)
-                    raise exc
-                except ldap.LDAPError as error:
-                    exc = error
-                    tries += 1
-                    if tries < self.retry_max:
-                        log.info('Failure attempting to create and bind '
-                                 'connector; will retry after %r seconds',
-                                 self.retry_delay, exc_info=True)
-                        time.sleep(self.retry_delay)
-                    else:
-                        log.error('Failure attempting to create and bind '
-                                  'connector', exc_info=True)
+        # timeout, etc.).
+        result = None
+        for server in self._servers:
+            # the first server is always tried, the next ones only until
+            # the deadline is reached
+            if result is not None and deadline is not None:
+                if time.monotonic() >= deadline:
+                    log.error('Failure attempting to create and bind '
+                              'connector; giving up after %r seconds',
+                              self.retry_deadline)
+                    break
+
+            result = self._try_bind(server, bind, passwd, deadline)
 
             # We successfully connected to one of the servers, so
             # we can just return the connection and stop processing
             # any additional URIs.
-            if connected:
-                return conn
+            if result.ok:
+                return result.conn
 
         # We failed to connect to any of the servers,
         # so raise an appropriate exception.
-        if not connected:
-            if isinstance(exc, (ldap.NO_SUCH_OBJECT,
-                                ldap.SERVER_DOWN,
-                                ldap.TIMEOUT)):
-                raise exc
+        exc = result.error
+        if isinstance(exc, _CONNECT_ERRORS):
+            raise exc
 
         # that's something else
-        raise BackendError(str(exc), backend=conn)
+        raise BackendError(str(exc), backend=result.conn)
+
+    def _try_bind(self, server, bind, passwd, deadline):
+        """Creates a connector to a server and binds it.
+
+        Failed attempts are retried up to retry_max times in a row, with
+        a fresh connector, unless the next retry would start after the
+        deadline.
+
+        :param server: LDAP server URI
+        :type server: string
+        :param deadline: monotonic time after which no retry is attempted,
+            or None
+        :returns: _BindResult
+        :raises ldap.INVALID_CREDENTIALS: If the credentials are rejected
+        """
+        tries = 0
+        exc = None
+        conn = None
+
+        while tries < self.retry_max:
+            try:
+                log.debug('Attempting to create a new connector '
+                          'to %s (attempt %d)', server, tries + 1)
+                conn = self.connector_cls(server, retry_max=self.retry_max,
+                                          retry_delay=self.retry_delay)
+                conn.timeout = self.timeout
+                conn.max_lifetime = self.max_lifetime
+                conn._search_cache = self._search_cache
+                self._bind(conn, bind, passwd)
+                return _BindResult(True, conn, None)
+            except ldap.INVALID_CREDENTIALS:
+                # Treat this as a hard failure instead of retrying to
+                # avoid locking out the LDAP account due to successive
+                # failed bind attempts.  We also don't want to try
+                # connecting to additional servers if multiple URIs were
+                # provide, as failed bind attempts may be replicated
+                # across multiple LDAP servers.
+                log.error('Invalid credentials. Cancelling retry',
+                          exc_info=True)
+                raise
+            except ldap.LDAPError as error:
+                exc = error
+                tries += 1
+                if tries >= self.retry_max:
+                    log.error('Failure attempting to create and bind '
+                              'connector', exc_info=True)
+                    break
+
+                delay = self._backoff(tries)
+                now = time.monotonic()
+                if deadline is not None and now + delay >= deadline:
+                    # let's leave the time left to the other servers
+                    log.error('Failure attempting to create and bind '
+                              'connector; not retrying %s before the '
+                              'deadline', server, exc_info=True)
+                    break
+
+                log.info('Failure attempting to create and bind '
+                         'connector; will retry after %r seconds',
+                         delay, exc_info=True)
+                time.sleep(delay)
+
+        return _BindResult(False, conn, exc)
+
+    def _backoff(self, tries):
+        """Returns the delay to wait for before the next bind attempt.
+
+        The delay grows exponentially with the number of failed tries and is
+        jittered so that workers hitting the same outage do not reconnect
+        in lockstep. It never exceeds max_backoff, unless max_backoff is
+        lower than retry_delay: the first retry always waits retry_delay.
+        """
+        delay = self.retry_delay * 2 ** (tries - 1)
+        delay += random.uniform(0, self.retry_delay)
+        if self.max_backoff is not None:
+            delay = min(delay, max(self.max_backoff, self.retry_delay))
+        return delay
+
+    def _prefill(self, count, parallel):
+        """Creates up to count inactive connectors bound as the default bind.
+
+        Failures are logged and leave the pool partially filled.
+        """
+        def create(_):
+            try:
+                return self._create_connector(self.bind, self.passwd)
+            except Exception:
+                log.warning('Failure attempting to prefill the pool',
+                            exc_info=True)
+                return None
+
+        # a first connector is created on its own, so that invalid default
+        # credentials are not sent to the server count times in parallel
+        conns = [create(0)]
+        if conns[0] is not None and count > 1:
+            if parallel:
+                workers = min(count - 1, _PREFILL_WORKERS_MAX)
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    conns.extend(executor.map(create, range(1, count)))
+            else:
+                conns.extend(create(i) for i in range(1, count))
+
+        with self._pool_lock:
+            for conn in conns:
+                if conn is not None:
+                    self._add_to_pool(conn, self._reserve_slot())
+                    self._push_inactive(conn)
 
     def _get_connection(self, bind=None, passwd=None):
         if bind is None:
@@ -296,41 +911,82 @@ class ConnectionManager(object):
         if passwd is None:
             passwd = self.passwd
 
-        if self.use_pool:
+        self._check_auth_failure(bind, passwd)
+
+        if not self.use_pool:
+            # with no pool, the connector is always active
+            conn = self._create_connector(bind, passwd)
+            conn.active = True
+            return conn
+
+        # if every connector is in use, wait for one to be released
+        if not self._capacity.acquire(
+                timeout=self.retry_max * _POOL_FULL_WAIT):
+            raise MaxConnectionReachedError(self.uri)
+
+        try:
             # let's try to recycle an existing one
             conn = self._match(bind, passwd)
-            if conn is not None:
-                return conn
+            if conn is None:
+                # we need to create a new connector
+                conn = self._create_pooled_connector(bind, passwd)
+        except BaseException:
+            self._capacity.release()
+            raise
+
+        return conn
+
+    def _create_pooled_connector(self, bind, passwd):
+        """Creates a connector in a free slot of the pool.
+
+        :raises MaxConnectionReachedError: If the pool is full
+        """
+        # the slot is reserved first, so that concurrent callers can't
+        # grow the pool beyond its size while connecting
+        with self._pool_lock:
+            slot = self._reserve_slot()
 
+        if slot is None:
             # the pool is full
-            if len(self._pool) >= self.size:
-                raise MaxConnectionReachedError(self.uri)
+            raise MaxConnectionReachedError(self.uri)
 
-        # we need to create a new connector
-        conn = self._create_connector(bind, passwd)
+        try:
+            conn = self._create_connector(bind, passwd)
+        except BaseException:
+            with self._pool_lock:
+                self._free_slots |= 1 << slot
+            raise
 
         # adding it to the pool
-        if self.use_pool:
-            with self._pool_lock:
-                self._pool.append(conn)
-        else:
-            # with no pool, the connector is always active
-            conn.active = True
+        with self._pool_lock:
+            self._add_to_pool(conn, slot)
+            self._active.add(conn)
 
         return conn
 
     def _release_connection(self, connection):
         if self.use_pool:
-            with self._pool_lock:
-                if not connection.connected:
-                    # unconnected connector, let's drop it
-                    self._pool.remove(connection)
-                else:
-                    # can be reused - let's mark is as not active
-                    connection.active = False
-
-                    # done.
-                    return
+            expiry = connection._expiry_time
+            expired = expiry is not None and time.monotonic() >= expiry
+            try:
+                with self._pool_lock:
+                    if not connection.connected:
+                        # unconnected connector, let's drop it
+                        self._discard(connection)
+                    elif expired:
+                        # this connector has lived for too long,
+                        # let's drop it
+                        self._discard(connection)
+                    else:
+                        # can be reused - let's mark is as not active
+                        self._active.discard(connection)
+                        self._push_inactive(connection)
+
+                        # done.
+                        return
+            finally:
+                # wake up a thread waiting for a connector
+                self._capacity.release()
         else:
             connection.active = False
 
@@ -353,27 +1009,7 @@ class ConnectionManager(object):
         :returns: StateConnector
         :raises MaxConnectionReachedError: If unable to connect to LDAP
         """
-        tries = 0
-        conn = None
-        while tries < self.retry_max:
-            try:
-                conn = self._get_connection(bind, passwd)
-            except MaxConnectionReachedError:
-                tries += 1
-                time.sleep(0.1)
-
-                # removing the first inactive connector going backward
-                with self._pool_lock:
-                    reversed_list = reversed(list(enumerate(self._pool)))
-                    for index, conn_ in reversed_list:
-                        if not conn_.active:
-                            self._pool.pop(index)
-                            break
-            else:
-                break
-
-        if conn is None:
-            raise MaxConnectionReachedError(self.uri)
+        conn = self._get_connection(bind, passwd)
 
         try:
             yield conn
@@ -388,41 +1024,70 @@ class ConnectionManager(object):
         :param passwd: user password
         :type passwd: string
         """
+        with self._pool_lock:
+            for key in [key for key in self._auth_failures
+                        if key[0] == bind]:
+                del self._auth_failures[key]
+
         if self.use_pool:
             return
 
         if passwd is not None:
             passwd = utf8_encode(passwd)
 
+        purged = []
         with self._pool_lock:
-            for conn in list(self._pool):
+            for conn in list(self._slots):
                 if conn.who != bind:
                     continue
 
                 if passwd is not None and conn.cred == passwd:
                     continue
                 # let's drop it
-                try:
-                    conn.unbind_ext_s()
-                except ldap.LDAPError:
-                    # invalid state
-                    log.debug('Failure attempting to unbind on purge; '
-                              'should be harmless', exc_info=True)
-                self._pool.remove(conn)
+                self._discard(conn)
+                purged.append(conn)
+
+        for conn in purged:
+            try:
+                conn.unbind_ext_s()
+            except ldap.LDAPError:
+                # invalid state
+                log.debug('Failure attempting to unbind on purge; '
+                          'should be harmless', exc_info=True)
+
+    def describe(self):
+        """Returns a table describing the state of every pooled connector.
+
+        :returns: string
+        """
+        from prettytable import PrettyTable
 
-    def __str__(self):
         table = PrettyTable()
         table.field_names = ['Slot (%d max)' % self.size,
                              'Connected', 'Active', 'URI',
-                             'Lifetime (%d max)' % self.max_lifetime,
+                             'Lifetime (%s max)' % self.max_lifetime,
                              'Bind DN']
 
+        # only read the connectors' state under the lock, the table is
+        # built once it has been released
         with self._pool_lock:
-            for slot, conn in enumerate(self._pool):
-                table.add_row([
-                    slot + 1,
-                    'connected' if conn.connected else 'not connected',
-                    'active' if conn.active else 'inactive',
-                    conn._uri, conn.get_lifetime(), conn.who])
+            snapshot = [(slot, conn.connected, conn.active, conn._uri,
+                         conn.get_lifetime(), conn.who)
+                        for slot, conn in enumerate(self._pool)
+                        if conn is not None]
+
+        for slot, connected, active, uri, lifetime, who in snapshot:
+            table.add_row([
+                slot + 1,
+                'connected' if connected else 'not connected',
+                'active' if active else 'inactive',
+                uri, lifetime, who])
 
         return str(table)
+
+    def __str__(self):
+        return self.describe()
+
+    def __repr__(self):
+        return '<ConnectionManager size=%d active=%d inactive=%d>' % (
+            self.size, len(self._active), len(self._inactive_order))
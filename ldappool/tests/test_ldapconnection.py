@@ -33,29 +33,32 @@
 # the terms of any one of the MPL, the GPL or the LGPL.
 #
 # ***** END LICENSE BLOCK *****
+import gc
+import time
 import unittest
+import weakref
 
 import ldap
 
 import ldappool
 
 
-def _bind(self, who='', cred='', **kw):
+def _bind(self, who='', cred='', *args):
     self.connected = True
     self.who = who
     self.cred = cred
     return 1
 
 
-def _bind_fails(self, who='', cred='', **kw):
+def _bind_fails(self, who='', cred='', *args):
     raise ldap.LDAPError('LDAP connection invalid')
 
 
-def _bind_fails_server_down(self, who='', cred='', **kw):
+def _bind_fails_server_down(self, who='', cred='', *args):
     raise ldap.SERVER_DOWN('LDAP connection invalid')
 
 
-def _bind_fails_server_down_failover(self, who='', cred='', **kw):
+def _bind_fails_server_down_failover(self, who='', cred='', *args):
     # Raise a server down error unless the URI is 'ldap://GOOD'
     if self._uri == 'ldap://GOOD':
         self.connected = True
@@ -66,11 +69,11 @@ def _bind_fails_server_down_failover(self, who='', cred='', **kw):
         raise ldap.SERVER_DOWN('LDAP connection invalid')
 
 
-def _bind_fails_timeout(self, who='', cred='', **kw):
+def _bind_fails_timeout(self, who='', cred='', *args):
     raise ldap.TIMEOUT('LDAP connection timeout')
 
 
-def _bind_fails_timeout_failover(self, who='', cred='', **kw):
+def _bind_fails_timeout_failover(self, who='', cred='', *args):
     # Raise a timeout error unless the URI is 'ldap://GOOD'
     if self._uri == 'ldap://GOOD':
         self.connected = True
@@ -81,11 +84,11 @@ def _bind_fails_timeout_failover(self, who='', cred='', **kw):
         raise ldap.TIMEOUT('LDAP connection timeout')
 
 
-def _bind_fails_invalid_credentials(self, who='', cred='', **kw):
+def _bind_fails_invalid_credentials(self, who='', cred='', *args):
     raise ldap.INVALID_CREDENTIALS('LDAP connection invalid')
 
 
-def _bind_fails_invalid_credentials_failover(self, who='', cred='', **kw):
+def _bind_fails_invalid_credentials_failover(self, who='', cred='', *args):
     # Raise invalid credentials erorr unless the URI is 'ldap://GOOD'
     if self._uri == 'ldap://GOOD':
         self.connected = True
@@ -96,7 +99,7 @@ def _bind_fails_invalid_credentials_failover(self, who='', cred='', **kw):
         raise ldap.INVALID_CREDENTIALS('LDAP connection invalid')
 
 
-def _bind_fails_tls_failover(self, who='', cred='', **kw):
+def _bind_fails_tls_failover(self, who='', cred='', *args):
     # Raise backend error unless the URI is 'ldap://GOOD'
     if self._uri == 'ldap://GOOD':
         self.connected = True
@@ -117,24 +120,69 @@ def _start_tls_s(self):
         raise ldap.SERVER_DOWN('LDAP connection invalid')
 
 
-class TestLDAPConnection(unittest.TestCase):
+class FakeStateConnector(ldappool.StateConnector):
+    start_tls_already_called_flag = False
+    simple_bind_s = _bind
+    start_tls_s = _start_tls_s
+
+
+class ServerDownConnector(FakeStateConnector):
+    simple_bind_s = _bind_fails_server_down
+
+
+class ServerDownFailoverConnector(FakeStateConnector):
+    simple_bind_s = _bind_fails_server_down_failover
+
+
+class TimeoutConnector(FakeStateConnector):
+    simple_bind_s = _bind_fails_timeout
+
+
+class TimeoutFailoverConnector(FakeStateConnector):
+    simple_bind_s = _bind_fails_timeout_failover
+
+
+class InvalidCredentialsConnector(FakeStateConnector):
+    simple_bind_s = _bind_fails_invalid_credentials
+
+
+class InvalidCredentialsFailoverConnector(FakeStateConnector):
+    simple_bind_s = _bind_fails_invalid_credentials_failover
+
+
+class TLSFailoverConnector(FakeStateConnector):
+    simple_bind_s = _bind_fails_tls_failover
+
 
-    def setUp(self):
-        self.old = ldappool.StateConnector.simple_bind_s
-        ldappool.StateConnector.simple_bind_s = _bind
-        self.old_start_tls_s = ldappool.StateConnector.start_tls_s
-        ldappool.StateConnector.start_tls_s = _start_tls_s
-        ldappool.StateConnector.start_tls_already_called_flag = False
+class ServerDownOnceConnector(FakeStateConnector):
 
-    def tearDown(self):
-        ldappool.StateConnector.simple_bind_s = self.old
-        ldappool.StateConnector.start_tls_s = self.old_start_tls_s
+    def __init__(self, *args, **kw):
+        FakeStateConnector.__init__(self, *args, **kw)
+        self.adds = 0
+
+    def add_ext(self, dn, modlist, serverctrls=None, clientctrls=None):
+        # the first add fails as if the server had closed the connection
+        self.adds += 1
+        if self.adds == 1:
+            raise ldap.SERVER_DOWN('LDAP connection invalid')
+        return 1
+
+    def result3(self, msgid=ldap.RES_ANY, all=1, timeout=None):
+        return ldap.RES_ADD, [], msgid, []
+
+    def _apply_last_bind(self):
+        # python-ldap binds the new connection again, there is no server
+        pass
+
+
+class TestLDAPConnection(unittest.TestCase):
 
     def test_connection(self):
         uri = ''
         dn = 'uid=adminuser,ou=logins,dc=mozilla'
         passwd = 'adminuser'
-        cm = ldappool.ConnectionManager(uri, dn, passwd, use_pool=True, size=2)
+        cm = ldappool.ConnectionManager(uri, dn, passwd, use_pool=True, size=2,
+                                        connector_cls=FakeStateConnector)
         self.assertEqual(len(cm), 0)
 
         with cm.connection('dn', 'pass'):
@@ -186,23 +234,34 @@ class TestLDAPConnection(unittest.TestCase):
         dn = 'uid=adminuser,ou=logins,dc=mozilla'
         passwd = 'adminuser'
         cm = ldappool.ConnectionManager(uri, dn, passwd, use_pool=True,
-                                        size=2, use_tls=True)
+                                        size=2, use_tls=True,
+                                        connector_cls=FakeStateConnector)
         with cm.connection():
             pass
 
-    def test_simple_bind_fails(self):
-        unbinds = []
+    def test_tls_connection_rebind(self):
+        uri = ''
+        dn = 'uid=adminuser,ou=logins,dc=mozilla'
+        passwd = 'adminuser'
+        cm = ldappool.ConnectionManager(uri, dn, passwd, use_pool=True,
+                                        size=1, use_tls=True,
+                                        connector_cls=FakeStateConnector)
+        with cm.connection('dn', 'pass') as conn:
+            pass
+
+        # rebinding the connector does not start TLS a second time
+        with cm.connection('dn2', 'pass') as conn2:
+            self.assertEqual(conn2.who, 'dn2')
 
-        def _unbind(self):
-            unbinds.append(1)
+        self.assertTrue(conn is conn2)
 
+    def test_simple_bind_fails(self):
         # the binding fails with an LDAPError
-        ldappool.StateConnector.simple_bind_s = _bind_fails_server_down
-        ldappool.StateConnector.unbind_s = _unbind
         uri = ''
         dn = 'uid=adminuser,ou=logins,dc=mozilla'
         passwd = 'adminuser'
-        cm = ldappool.ConnectionManager(uri, dn, passwd, use_pool=True, size=2)
+        cm = ldappool.ConnectionManager(uri, dn, passwd, use_pool=True, size=2,
+                                        connector_cls=ServerDownConnector)
         self.assertEqual(len(cm), 0)
 
         try:
@@ -214,20 +273,14 @@ class TestLDAPConnection(unittest.TestCase):
             raise AssertionError()
 
     def test_simple_bind_fails_failover(self):
-        unbinds = []
-
-        def _unbind(self):
-            unbinds.append(1)
-
         # the binding to any server other than 'ldap://GOOD' fails
         # with ldap.SERVER_DOWN
-        ldappool.StateConnector.simple_bind_s = \
-            _bind_fails_server_down_failover
-        ldappool.StateConnector.unbind_s = _unbind
         uri = 'ldap://BAD,ldap://GOOD'
         dn = 'uid=adminuser,ou=logins,dc=mozilla'
         passwd = 'adminuser'
-        cm = ldappool.ConnectionManager(uri, dn, passwd, use_pool=True, size=2)
+        cm = ldappool.ConnectionManager(
+            uri, dn, passwd, use_pool=True, size=2,
+            connector_cls=ServerDownFailoverConnector)
         self.assertEqual(len(cm), 0)
 
         try:
@@ -240,18 +293,12 @@ class TestLDAPConnection(unittest.TestCase):
             raise AssertionError()
 
     def test_simple_bind_fails_timeout(self):
-        unbinds = []
-
-        def _unbind(self):
-            unbinds.append(1)
-
         # the binding fails with ldap.TIMEOUT
-        ldappool.StateConnector.simple_bind_s = _bind_fails_timeout
-        ldappool.StateConnector.unbind_s = _unbind
         uri = ''
         dn = 'uid=adminuser,ou=logins,dc=mozilla'
         passwd = 'adminuser'
-        cm = ldappool.ConnectionManager(uri, dn, passwd, use_pool=True, size=2)
+        cm = ldappool.ConnectionManager(uri, dn, passwd, use_pool=True, size=2,
+                                        connector_cls=TimeoutConnector)
         self.assertEqual(len(cm), 0)
 
         try:
@@ -263,19 +310,14 @@ class TestLDAPConnection(unittest.TestCase):
             raise AssertionError()
 
     def test_simple_bind_fails_timeout_failover(self):
-        unbinds = []
-
-        def _unbind(self):
-            unbinds.append(1)
-
         # the binding to any server other than 'ldap://GOOD' fails
         # with ldap.TIMEOUT
-        ldappool.StateConnector.simple_bind_s = _bind_fails_timeout_failover
-        ldappool.StateConnector.unbind_s = _unbind
         uri = 'ldap://BAD,ldap://GOOD'
         dn = 'uid=adminuser,ou=logins,dc=mozilla'
         passwd = 'adminuser'
-        cm = ldappool.ConnectionManager(uri, dn, passwd, use_pool=True, size=2)
+        cm = ldappool.ConnectionManager(
+            uri, dn, passwd, use_pool=True, size=2,
+            connector_cls=TimeoutFailoverConnector)
         self.assertEqual(len(cm), 0)
 
         try:
@@ -288,18 +330,13 @@ class TestLDAPConnection(unittest.TestCase):
             raise AssertionError()
 
     def test_simple_bind_fails_invalid_credentials(self):
-        unbinds = []
-
-        def _unbind(self):
-            unbinds.append(1)
-
         # the binding fails with an LDAPError
-        ldappool.StateConnector.simple_bind_s = _bind_fails_invalid_credentials
-        ldappool.StateConnector.unbind_s = _unbind
         uri = ''
         dn = 'uid=adminuser,ou=logins,dc=mozilla'
         passwd = 'adminuser'
-        cm = ldappool.ConnectionManager(uri, dn, passwd, use_pool=True, size=2)
+        cm = ldappool.ConnectionManager(
+            uri, dn, passwd, use_pool=True, size=2,
+            connector_cls=InvalidCredentialsConnector)
         self.assertEqual(len(cm), 0)
 
         try:
@@ -311,20 +348,14 @@ class TestLDAPConnection(unittest.TestCase):
             raise AssertionError()
 
     def test_simple_bind_fails_invalid_credentials_failover(self):
-        unbinds = []
-
-        def _unbind(self):
-            unbinds.append(1)
-
         # the binding to any server other than 'ldap://GOOD' fails
         # with ldap.INVALID_CREDENTIALS
-        ldappool.StateConnector.simple_bind_s = \
-            _bind_fails_invalid_credentials_failover
-        ldappool.StateConnector.unbind_s = _unbind
         uri = 'ldap://BAD,ldap://GOOD'
         dn = 'uid=adminuser,ou=logins,dc=mozilla'
         passwd = 'adminuser'
-        cm = ldappool.ConnectionManager(uri, dn, passwd, use_pool=True, size=2)
+        cm = ldappool.ConnectionManager(
+            uri, dn, passwd, use_pool=True, size=2,
+            connector_cls=InvalidCredentialsFailoverConnector)
         self.assertEqual(len(cm), 0)
 
         try:
@@ -339,20 +370,14 @@ class TestLDAPConnection(unittest.TestCase):
             raise AssertionError()
 
     def test_simple_bind_fails_tls_failover(self):
-        unbinds = []
-
-        def _unbind(self):
-            unbinds.append(1)
-
         # the binding to any server other than 'ldap://GOOD' fails
         # with ldap.SERVER_DOWN
-        ldappool.StateConnector.simple_bind_s = _bind_fails_tls_failover
-        ldappool.StateConnector.unbind_s = _unbind
         uri = 'ldap://BAD,ldap://GOOD'
         dn = 'uid=adminuser,ou=logins,dc=mozilla'
         passwd = 'adminuser'
         cm = ldappool.ConnectionManager(uri, dn, passwd, use_pool=True,
-                                        size=2, use_tls=True)
+                                        size=2, use_tls=True,
+                                        connector_cls=TLSFailoverConnector)
         self.assertEqual(len(cm), 0)
 
         try:
@@ -363,3 +388,241 @@ class TestLDAPConnection(unittest.TestCase):
                 pass
         except Exception:
             raise AssertionError()
+
+    def test_discarded_connector_freed(self):
+        uri = ''
+        dn = 'uid=adminuser,ou=logins,dc=mozilla'
+        passwd = 'adminuser'
+        cm = ldappool.ConnectionManager(uri, dn, passwd, use_pool=True, size=2,
+                                        connector_cls=FakeStateConnector)
+
+        # the connector gets a deadline once back in the pool
+        with cm.connection() as conn:
+            conn._expiry_time = time.monotonic() + 600
+
+        self.assertEqual(len(cm._expiry_heap), 1)
+
+        with cm.connection() as conn:
+            conn.connected = False
+
+        # forgetting about the connector does not wait for its deadline
+        self.assertEqual(len(cm), 0)
+        ref = weakref.ref(conn)
+        del conn
+        gc.collect()
+        self.assertIsNone(ref())
+
+        # and stale deadlines do not pile up in the heap
+        for i in range(10):
+            with cm.connection() as conn:
+                conn._expiry_time = time.monotonic() + 600
+            with cm.connection() as conn:
+                conn.connected = False
+
+        self.assertLessEqual(len(cm._expiry_heap), 2 * cm.size)
+
+    def test_reconnect(self):
+        uri = ''
+        dn = 'uid=adminuser,ou=logins,dc=mozilla'
+        passwd = 'adminuser'
+        cm = ldappool.ConnectionManager(uri, dn, passwd, use_pool=True, size=2,
+                                        connector_cls=ServerDownOnceConnector)
+
+        with cm.connection('dn', 'pass') as conn:
+            # the fake bind does not start the lifetime of the connector
+            conn._connection_time = 0
+            conn.add_s('cn=foo,dc=mozilla', [('cn', [b'foo'])])
+
+            # python-ldap reconnected and retried the operation
+            self.assertEqual(conn.adds, 2)
+
+            # the connector is still bound as before, for a new lifetime
+            self.assertTrue(conn.connected)
+            self.assertEqual(conn.who, 'dn')
+            self.assertEqual(conn.cred, 'pass')
+            self.assertGreater(conn._connection_time, 0)
+            self.assertEqual(conn._expiry_time, conn._connection_time + 600)
+
+        # so it goes back to the pool
+        self.assertEqual(len(cm), 1)
+
+        with cm.connection('dn', 'pass') as conn2:
+            pass
+
+        self.assertIs(conn, conn2)
+
+    def test_describe(self):
+        uri = ''
+        dn = 'uid=adminuser,ou=logins,dc=mozilla'
+        passwd = 'adminuser'
+        cm = ldappool.ConnectionManager(uri, dn, passwd, use_pool=True, size=2,
+                                        connector_cls=FakeStateConnector)
+
+        with cm.connection('dn', 'pass'):
+            self.assertEqual(repr(cm), '<ConnectionManager size=2 '
+                                       'active=1 inactive=0>')
+            table = cm.describe()
+            self.assertIn('Slot (2 max)', table)
+            self.assertIn('Lifetime (600 max)', table)
+            self.assertIn(' active ', table)
+            self.assertIn('dn', table)
+
+        self.assertEqual(repr(cm), '<ConnectionManager size=2 '
+                                   'active=0 inactive=1>')
+        self.assertIn(' inactive ', str(cm))
+
+        # connectors may have no maximum lifetime
+        cm = ldappool.ConnectionManager(uri, dn, passwd, max_lifetime=None,
+                                        connector_cls=FakeStateConnector)
+        self.assertIn('Lifetime (None max)', cm.describe())
+
+    def test_retry_backoff(self):
+        cm = ldappool.ConnectionManager('', retry_delay=.1, max_backoff=.5)
+
+        # the first retry waits between retry_delay and twice that
+        delay = cm._backoff(1)
+        self.assertTrue(.1 <= delay <= .2)
+
+        # then the delay doubles on each failed attempt
+        delay = cm._backoff(3)
+        self.assertTrue(.4 <= delay <= .5)
+
+        # but never goes beyond max_backoff
+        self.assertEqual(cm._backoff(10), .5)
+
+        # which does not shorten the configured retry_delay
+        cm = ldappool.ConnectionManager('', retry_delay=30, max_backoff=10)
+        self.assertEqual(cm._backoff(1), 30)
+
+        # and is not set by default
+        cm = ldappool.ConnectionManager('', retry_delay=30)
+        self.assertGreaterEqual(cm._backoff(2), 60)
+
+    def test_retry_deadline(self):
+        uri = 'ldap://BAD'
+        dn = 'uid=adminuser,ou=logins,dc=mozilla'
+        passwd = 'adminuser'
+        cm = ldappool.ConnectionManager(uri, dn, passwd, use_pool=True,
+                                        size=2, retry_max=10, retry_delay=.1,
+                                        retry_deadline=.3,
+                                        connector_cls=ServerDownConnector)
+
+        def tryit():
+            with cm.connection():
+                pass
+
+        # retries stop before the deadline instead of after retry_max
+        start = time.monotonic()
+        self.assertRaises(ldap.SERVER_DOWN, tryit)
+        self.assertLess(time.monotonic() - start, .3)
+
+    def test_retry_deadline_failover(self):
+        uri = 'ldap://BAD,ldap://GOOD'
+        dn = 'uid=adminuser,ou=logins,dc=mozilla'
+        passwd = 'adminuser'
+        cm = ldappool.ConnectionManager(
+            uri, dn, passwd, use_pool=True, size=2, retry_delay=.5,
+            retry_deadline=.5, connector_cls=ServerDownFailoverConnector)
+
+        # the first server is not retried past the deadline, but the
+        # time left is used to try the second one
+        start = time.monotonic()
+        with cm.connection('dn', 'pass') as conn:
+            self.assertEqual(conn._uri, 'ldap://GOOD')
+        self.assertLess(time.monotonic() - start, .5)
+
+    def test_simple_bind_fails_invalid_credentials_cached(self):
+        binds = []
+
+        def _bind_fails_counted(self, who='', cred='', *args):
+            binds.append((who, cred))
+            raise ldap.INVALID_CREDENTIALS('LDAP connection invalid')
+
+        class CountedConnector(FakeStateConnector):
+            simple_bind_s = _bind_fails_counted
+
+        uri = ''
+        dn = 'uid=adminuser,ou=logins,dc=mozilla'
+        passwd = 'adminuser'
+        cm = ldappool.ConnectionManager(uri, dn, passwd, use_pool=True,
+                                        size=2, auth_failure_ttl=60,
+                                        connector_cls=CountedConnector)
+
+        def tryit(passwd):
+            with cm.connection('dn', passwd):
+                pass
+
+        self.assertRaises(ldap.INVALID_CREDENTIALS, tryit, 'pass')
+        self.assertEqual(len(binds), 1)
+
+        # the failure is remembered, the server is not asked again
+        self.assertRaises(ldap.INVALID_CREDENTIALS, tryit, 'pass')
+        self.assertEqual(len(binds), 1)
+
+        # but other credentials are still tried
+        self.assertRaises(ldap.INVALID_CREDENTIALS, tryit, 'pass2')
+        self.assertEqual(len(binds), 2)
+
+        # purging the bind forgets about its failures
+        cm.purge('dn')
+        self.assertRaises(ldap.INVALID_CREDENTIALS, tryit, 'pass')
+        self.assertEqual(len(binds), 3)
+
+    def test_prefill(self):
+        uri = ''
+        dn = 'uid=adminuser,ou=logins,dc=mozilla'
+        passwd = 'adminuser'
+        cm = ldappool.ConnectionManager(uri, dn, passwd, use_pool=True,
+                                        size=2, prefill=3,
+                                        connector_cls=FakeStateConnector)
+
+        # the pool is filled up to its size with inactive connectors
+        self.assertEqual(len(cm), 2)
+        self.assertFalse(cm._pool[0].active)
+        self.assertFalse(cm._pool[1].active)
+
+        # which get reused
+        with cm.connection() as conn:
+            self.assertIn(conn, cm._pool)
+            self.assertEqual(len(cm), 2)
+
+        self.assertEqual(len(cm), 2)
+
+        # without a default bind, the connectors could not be reused
+        cm = ldappool.ConnectionManager(uri, use_pool=True, size=2, prefill=2,
+                                        connector_cls=FakeStateConnector)
+        self.assertEqual(len(cm), 0)
+
+    def test_connection_expiry(self):
+        uri = ''
+        dn = 'uid=adminuser,ou=logins,dc=mozilla'
+        passwd = 'adminuser'
+        cm = ldappool.ConnectionManager(uri, dn, passwd, use_pool=True, size=2,
+                                        connector_cls=FakeStateConnector)
+
+        with cm.connection() as conn:
+            # deadlines are taken from the monotonic clock
+            conn._expiry_time = time.monotonic() + .1
+
+        # the connector is reused until it reaches its deadline
+        with cm.connection() as conn2:
+            pass
+
+        self.assertTrue(conn is conn2)
+
+        time.sleep(.1)
+
+        # then it gets dropped from the pool
+        with cm.connection() as conn2:
+            pass
+
+        self.assertTrue(conn is not conn2)
+        self.assertNotIn(conn, cm._pool)
+        self.assertEqual(len(cm), 1)
+
+        # connectors reaching their deadline while in use are dropped
+        # when released
+        with cm.connection() as conn:
+            conn._expiry_time = time.monotonic()
+
+        self.assertEqual(len(cm), 0)
@@ -41,17 +41,6 @@ import ldap
 
 import ldappool
 
-# patching StateConnector
-ldappool.StateConnector.users = {
-    'uid=tarek,ou=users,dc=mozilla':
-        {'uidNumber': ['1'],
-         'account-enabled': ['Yes'],
-         'mail': ['tarek@mozilla.com'],
-         'cn': ['tarek']},
-    'cn=admin,dc=mozilla': {'cn': ['admin'],
-                            'mail': ['admin'],
-                            'uidNumber': ['100']}}
-
 
 def _simple_bind(self, who='', cred='', *args):
     self.connected = True
@@ -59,9 +48,6 @@ def _simple_bind(self, who='', cred='', *args):
     self.cred = cred
 
 
-ldappool.StateConnector.simple_bind_s = _simple_bind
-
-
 def _search(self, dn, *args, **kw):
     if dn in self.users:
         return [(dn, self.users[dn])]
@@ -75,9 +61,6 @@ def _search(self, dn, *args, **kw):
     raise ldap.NO_SUCH_OBJECT
 
 
-ldappool.StateConnector.search_s = _search
-
-
 def _add(self, dn, user):
     self.users[dn] = {}
     for key, value in user:
@@ -88,9 +71,6 @@ def _add(self, dn, user):
     return ldap.RES_ADD, ''
 
 
-ldappool.StateConnector.add_s = _add
-
-
 def _modify(self, dn, user):
     if dn in self.users:
         for type_, key, value in user:
@@ -100,16 +80,27 @@ def _modify(self, dn, user):
     return ldap.RES_MODIFY, ''
 
 
-ldappool.StateConnector.modify_s = _modify
-
-
 def _delete(self, dn):
     if dn in self.users:
         del self.users[dn]
     return ldap.RES_DELETE, ''
 
 
-ldappool.StateConnector.delete_s = _delete
+class FakeStateConnector(ldappool.StateConnector):
+    users = {
+        'uid=tarek,ou=users,dc=mozilla':
+            {'uidNumber': ['1'],
+             'account-enabled': ['Yes'],
+             'mail': ['tarek@mozilla.com'],
+             'cn': ['tarek']},
+        'cn=admin,dc=mozilla': {'cn': ['admin'],
+                                'mail': ['admin'],
+                                'uidNumber': ['100']}}
+    simple_bind_s = _simple_bind
+    search_s = _search
+    add_s = _add
+    modify_s = _modify
+    delete_s = _delete
 
 
 class LDAPWorker(threading.Thread):
@@ -137,7 +128,8 @@ class TestLDAPSQLAuth(unittest.TestCase):
     def test_pool(self):
         dn = 'uid=adminuser,ou=logins,dc=mozilla'
         passwd = 'adminuser'
-        pool = ldappool.ConnectionManager('ldap://localhost', dn, passwd)
+        pool = ldappool.ConnectionManager('ldap://localhost', dn, passwd,
+                                          connector_cls=FakeStateConnector)
         workers = [LDAPWorker(pool) for i in range(10)]
 
         for worker in workers:
@@ -154,7 +146,7 @@ class TestLDAPSQLAuth(unittest.TestCase):
         passwd = 'adminuser'
         pool = ldappool.ConnectionManager(
             'ldap://localhost', dn, passwd, size=1, retry_delay=1.,
-            retry_max=5, use_pool=True)
+            retry_max=5, use_pool=True, connector_cls=FakeStateConnector)
 
         class Worker(threading.Thread):
 
@@ -202,11 +194,16 @@ class TestLDAPSQLAuth(unittest.TestCase):
         # we still have one active connector
         self.assertEqual(len(pool), 1)
 
+        # the slots are allocated once, the size can't change
+        self.assertRaises(AttributeError, setattr, pool, 'size', 2)
+        self.assertEqual(pool.size, 1)
+
     def test_pool_cleanup(self):
         dn = 'uid=adminuser,ou=logins,dc=mozilla'
         passwd = 'adminuser'
         pool = ldappool.ConnectionManager('ldap://localhost', dn, passwd,
-                                          size=1, use_pool=True)
+                                          size=1, use_pool=True,
+                                          connector_cls=FakeStateConnector)
         with pool.connection('bind1') as conn:  # NOQA
             pass
 
@@ -221,7 +218,8 @@ class TestLDAPSQLAuth(unittest.TestCase):
         dn = 'uid=adminuser,ou=logins,dc=mozilla'
         passwd = 'adminuser'
         pool = ldappool.ConnectionManager('ldap://localhost', dn, passwd,
-                                          use_pool=True)
+                                          use_pool=True,
+                                          connector_cls=FakeStateConnector)
 
         with pool.connection() as conn:
             self.assertTrue(conn.active)
@@ -265,3 +263,146 @@ class TestLDAPSQLAuth(unittest.TestCase):
             pass
 
         self.assertTrue(conn is conn2)
+
+    def test_search_cache(self):
+        cache = ldappool._SearchCache(ttl=.1, size=2,
+                                      base_dns=['dc=mozilla'])
+        dn = 'cn=admin,dc=mozilla'
+        result = [(dn, {'cn': ['admin']})]
+
+        key = cache.key('bind', dn, ldap.SCOPE_BASE, '(objectClass=*)',
+                        ['cn'], 0)
+        self.assertEqual(cache.get(key), None)
+        cache.set(key, result)
+
+        # DNs are normalized and attributes order does not matter
+        same_key = cache.key('bind', 'CN=admin, DC=mozilla', ldap.SCOPE_BASE,
+                             '(objectClass=*)', ['cn'], 0)
+        self.assertEqual(cache.get(same_key), result)
+
+        # callers get their own copy of the results
+        cache.get(key)[0][1]['cn'].append('root')
+        self.assertEqual(cache.get(key), result)
+
+        # other users do not see cached results
+        other_key = cache.key('bind2', dn, ldap.SCOPE_BASE,
+                              '(objectClass=*)', ['cn'], 0)
+        self.assertEqual(cache.get(other_key), None)
+
+        # searches outside of the base DNs are not cached
+        self.assertEqual(cache.key('bind', 'dc=example', ldap.SCOPE_BASE,
+                                   '(objectClass=*)', None, 0), None)
+
+        # results expire
+        time.sleep(.1)
+        self.assertEqual(cache.get(key), None)
+
+        # the least recently used search gets dropped
+        subtree_key = cache.key('bind', 'dc=mozilla', ldap.SCOPE_SUBTREE,
+                                '(cn=admin)', None, 0)
+        cache.set(key, result)
+        cache.set(subtree_key, result)
+        cache.set(other_key, result)
+        self.assertEqual(cache.get(key), None)
+        self.assertEqual(cache.get(subtree_key), result)
+
+        # writing an entry drops the searches that may contain it
+        cache.invalidate(dn)
+        self.assertEqual(cache.get(subtree_key), None)
+        self.assertEqual(cache.get(other_key), None)
+
+        # escaped commas are part of the values
+        john = cache.key('bind', r'cn=Smith\, John,dc=mozilla',
+                         ldap.SCOPE_BASE, '(objectClass=*)', None, 0)
+        john2 = cache.key('bind', r'cn=Smith\,John,dc=mozilla',
+                          ldap.SCOPE_BASE, '(objectClass=*)', None, 0)
+        self.assertNotEqual(john, john2)
+        cache.set(john, result)
+        cache.set(john2, result)
+        cache.invalidate(r'cn=Smith\,John,dc=mozilla')
+        self.assertEqual(cache.get(john), result)
+        self.assertEqual(cache.get(john2), None)
+        self.assertEqual(cache.key('bind', r'cn=x\,dc=mozilla',
+                                   ldap.SCOPE_BASE, '(objectClass=*)', None,
+                                   0), None)
+
+    def test_search_cache_connector(self):
+        searches = []
+
+        class Connector(ldappool.StateConnector):
+            # only the calls reaching the network are faked, so that the
+            # StateConnector and python-ldap methods above them are used
+
+            def __init__(self, *args, **kw):
+                ldappool.StateConnector.__init__(self, *args, **kw)
+                self.adds = 0
+
+            def simple_bind(self, who=None, cred=None, serverctrls=None,
+                            clientctrls=None):
+                return 1
+
+            def result3(self, msgid=ldap.RES_ANY, all=1, timeout=None):
+                return ldap.RES_BIND, [], msgid, []
+
+            def search_ext_s(self, base, scope, *args, **kw):
+                who = self._last_bind[1][0]
+                searches.append(who)
+                return [(base, {'seen_by': [who]})]
+
+            def add_ext(self, dn, modlist, *args, **kw):
+                # the first add fails as if the server had closed the
+                # connection, python-ldap reconnects and binds again
+                self.adds += 1
+                if self.adds == 1:
+                    raise ldap.SERVER_DOWN('LDAP connection invalid')
+                return 1
+
+            def modify_ext(self, dn, modlist, *args, **kw):
+                return 1
+
+            def rename(self, dn, newrdn, *args, **kw):
+                return 1
+
+        pool = ldappool.ConnectionManager('ldap://localhost', size=2,
+                                          cache_ttl=60,
+                                          connector_cls=Connector)
+        dn = 'cn=secret,dc=mozilla'
+
+        with pool.connection('cn=alice', 'alice') as alice:
+            res = alice.search_s(dn, ldap.SCOPE_BASE)
+            self.assertEqual(res, [(dn, {'seen_by': ['cn=alice']})])
+
+            # the second search is answered by the cache
+            self.assertEqual(alice.search_s(dn, ldap.SCOPE_BASE), res)
+            self.assertEqual(searches, ['cn=alice'])
+
+            # writing the entry drops it from the cache
+            alice.add_s(dn, [('cn', [b'secret'])])
+            self.assertEqual(alice.search_s(dn, ldap.SCOPE_BASE), res)
+            self.assertEqual(searches, ['cn=alice'] * 2)
+
+            # so does writing it through the *_ext_s methods
+            alice.modify_ext_s(dn, [(ldap.MOD_REPLACE, 'cn', [b'secret'])])
+            self.assertEqual(alice.search_s(dn, ldap.SCOPE_BASE), res)
+            self.assertEqual(searches, ['cn=alice'] * 3)
+
+            with pool.connection('cn=bob', 'bob') as bob:
+                # even once reconnected, bob never gets the results of
+                # alice's searches
+                bob.add_s('cn=other,dc=mozilla', [('cn', [b'other'])])
+                self.assertEqual(bob.search_s(dn, ldap.SCOPE_BASE),
+                                 [(dn, {'seen_by': ['cn=bob']})])
+                self.assertEqual(searches, ['cn=alice'] * 3 + ['cn=bob'])
+
+            # renaming an entry drops the searches on its new DN too
+            renamed = 'cn=Doe,dc=mozilla'
+            alice.search_s(renamed, ldap.SCOPE_BASE)
+            alice.rename_s(r'cn=Smith\, ou=x,dc=mozilla', 'cn=Doe')
+            alice.search_s(renamed, ldap.SCOPE_BASE)
+            self.assertEqual(searches[3:], ['cn=bob', 'cn=alice',
+                                            'cn=alice'])
+
+            # disconnected connectors do not use the cache
+            alice.connected = False
+            alice.search_s(dn, ldap.SCOPE_BASE)
+            self.assertEqual(len(searches), 7)